@@ -26,6 +26,13 @@
 #       to keep path rewrites.
 #       Replaced print with print() statements for python3 compatability.
 #       Fixed urllib references to work with python 2 or 3.
+# 0.22: parse the XML with lxml when it is installed, much faster than
+#       plistlib on large libraries, or ElementTree otherwise.
+#       Only the parts of the XML that are used are kept in memory.
+#       Added the --jobs option to copy several tracks at the same time.
+#       Added the --link option to hard link tracks rather than copy them
+#       when the destination is on the same filesystem.
+#       Now requires Python 3.6 or later.
 #
 ###########################################################################
 # Export iTunes(TM) playlists from the XML file and sync a set of
@@ -41,26 +48,26 @@
 # Ignores the existence of non-local tracks (those without a size) which
 # are streaming URLs and such.
 #
-# Tested with Python 2.6 and 2.7 on OSX.
-# Requires plistlib which is included with Python 2.6 or later.
-# This may work for earlier versions of Python:
-#   http://svn.python.org/projects/python/trunk/Lib/plistlib.py
-# argparse shipped with Python 2.7 or later, on OSX 10.6.* run:
-#   sudo /usr/bin/easy_install-2.6 argparse
-#   sudo chmod -R a+rX /Library/Python/2.6/site-packages
-# or install newer python with macports, etc.
+# Requires Python 3.6 or later, older versions including Python 2 are
+# no longer supported.
+# Uses lxml to parse the XML if it is available (pip3 install lxml),
+# otherwise falls back to ElementTree which is included with Python.
 #
 # 0.21 tested with Python 3.7.2 on OSX.
 #
 # WARNING: will remove anything under the music and playlists
 # directories that it isn't syncing on this run!
+# With --link the synced tracks are hard links sharing their data with
+# the library, changing a synced track's contents changes the original.
 #
 ############################################################################
 
 import argparse
-import copy
+import base64
+import concurrent.futures
+import datetime
+import errno
 import os
-import plistlib
 import re
 import shutil
 import sys
@@ -73,19 +80,123 @@ except ImportError:
     from urllib.parse import urlsplit
     from urllib.parse import unquote
 
+try:
+    from lxml import etree
+except ImportError:
+    import xml.etree.ElementTree as etree
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+###########################################################################
+# Symbols for each power of 1024 bytes, used by bytes2human.
+BYTES_SYMBOLS = ('B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
+
 ###########################################################################
 # Convert a number of bytes into something human readable.
 # Taken from: http://goo.gl/zeJZl
 def bytes2human(n, format='%(value).4g%(symbol)s'):
-  symbols = ('B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
-  prefix = {}
-  for i, s in enumerate(symbols[1:]):
-    prefix[s] = 1 << (i+1)*10
-  for symbol in reversed(symbols[1:]):
-    if n >= prefix[symbol]:
-      value = float(n) / prefix[symbol]
-      return format % locals()
-  return format % dict(symbol=symbols[0], value=n)
+  # Every 10 bits of the number is another power of 1024.
+  index = min((int(n).bit_length() - 1) // 10, len(BYTES_SYMBOLS) - 1)
+  if index <= 0:
+    return format % dict(symbol=BYTES_SYMBOLS[0], value=n)
+  value = float(n) / (1 << index * 10)
+  return format % dict(symbol=BYTES_SYMBOLS[index], value=value)
+
+###########################################################################
+# Convert the text of plist value elements to python types, matching
+# what plistlib returns.
+PLIST_TYPES = {
+  'string': lambda text: text or '',
+  'integer': int,
+  'real': float,
+  'true': lambda text: True,
+  'false': lambda text: False,
+  'date': lambda text: datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ'),
+  'data': lambda text: base64.b64decode(text or ''),
+}
+
+# Schema marker for values that read_plist() should skip.
+PLIST_SKIP = object()
+
+###########################################################################
+# Parse a plist XML file into the same nested dicts and lists plistlib
+# would produce, keeping only the parts of it given in schema.
+#
+# A dict schema lists the keys to keep from a dict, with '*' matching
+# any key. A list schema holds the schema for every item in an array.
+# None keeps the whole value. Values that are not kept are parsed but
+# never converted and elements are cleared as soon as they have been
+# used, so large files don't have to be held in memory twice.
+def read_plist(f, schema=None):
+  containers = []
+  keys = []
+  schemas = []
+  skip = 0
+  value = None
+  for event, elem in etree.iterparse(f, events=('start', 'end')):
+    tag = elem.tag
+    if event == 'start':
+      if skip:
+        skip += 1
+      elif tag not in ('key', 'plist'):
+        # Find the schema for this value from whatever contains it.
+        if not containers:
+          value_schema = schema
+        elif schemas[-1] is None:
+          value_schema = None
+        elif keys[-1] is None:
+          value_schema = schemas[-1][0]
+        elif keys[-1] in schemas[-1]:
+          value_schema = schemas[-1][keys[-1]]
+        else:
+          value_schema = schemas[-1].get('*', PLIST_SKIP)
+
+        if value_schema is PLIST_SKIP:
+          skip = 1
+        elif tag == 'dict':
+          containers.append({})
+          keys.append(u'')
+          schemas.append(value_schema)
+        elif tag == 'array':
+          containers.append([])
+          keys.append(None)
+          schemas.append(value_schema)
+      continue
+
+    if skip:
+      skip -= 1
+      elem.clear()
+      continue
+    if tag == 'key':
+      keys[-1] = elem.text or u''
+      elem.clear()
+      continue
+    if tag == 'plist':
+      break
+    if tag in ('dict', 'array'):
+      value = containers.pop()
+      keys.pop()
+      schemas.pop()
+    else:
+      value = PLIST_TYPES[tag](elem.text)
+    elem.clear()
+
+    # Add the finished value to whatever contains it.
+    if containers:
+      if keys[-1] is None:
+        containers[-1].append(value)
+      else:
+        containers[-1][keys[-1]] = value
+  return value
+
+###########################################################################
+# Regular expressions used by fat32_convert, compiled once rather than
+# for every track.
+MULTI_SPACE_RE = re.compile(' +')
+NON_FAT32_RE = re.compile('[^-_.&%%#@a-zA-Z0-9:\\/%s ]' % re.escape(os.sep))
 
 ###########################################################################
 # Convert local filename to a fat32 valid filename relative to playlist.
@@ -99,7 +210,7 @@ def fat32_convert(filename, oldbase=None, newbase=os.sep):
 
   # If we have a directory prefix to remove, remove it.
   if oldbase is not None:
-    filename = filename.split(oldbase)[1]
+    filename = filename.split(oldbase, 1)[1]
 
   if not FLAGS.nolowercase:
     filename = filename.lower()
@@ -109,9 +220,11 @@ def fat32_convert(filename, oldbase=None, newbase=os.sep):
     ## -- Can't do this, breaks paths.
     #filename = re.sub('[%s]' % os.sep, '-', filename)
     # Also get rid of multiple runs of spaces, confuses some systems.
-    filename = re.sub(' +', ' ', filename)
+    # Most names have none, so only run the regex when there are.
+    if '  ' in filename:
+      filename = MULTI_SPACE_RE.sub(' ', filename)
     # Final cleanup of non-fat32 chars.
-    filename = re.sub('[^-_.&%%#@a-zA-Z0-9:\\/%s ]' % os.sep, '-', filename)
+    filename = NON_FAT32_RE.sub('-', filename)
 
   return os.path.join(newbase, filename)
 
@@ -124,17 +237,15 @@ def quote_list(text_list):
   return '\'' + '\', \''.join(text_list) + '\''
 
 ###########################################################################
-# Check if destination directory and its parents up to stopdir exist.
-# Recursive function.
+# Make sure destination directory and its parents up to stopdir exist.
 def mk_missing_dirs(direct, stopdir):
-  if direct != stopdir and not os.path.isdir(direct):
-    mk_missing_dirs(os.path.dirname(direct), stopdir)
+  if direct != stopdir:
     #print('Making directory %s' % direct)
     try:
-      os.mkdir(direct)
+      os.makedirs(direct, exist_ok=True)
     except (IOError, OSError) as e:
       error_exit('Failed to create directory "%s":\n  %s' %
-                 (full_file, e), code=6)
+                 (direct, e), code=6)
 
 ###########################################################################
 # Make directories from a list.
@@ -153,59 +264,193 @@ def mkdirs(dirs):
                      (path, e), code=6)
 
 ###########################################################################
-def clean_tree(base, keep_list):
-  # Remove files that are not in keep_list and also any empty
+def clean_tree(base, keep_set):
+  # Remove files that are not in keep_set and also any empty
   # directories. Do not remove base.
   file_count = 0
   dir_count = 0
-
-  for root, dirs, files in os.walk(base, topdown=False):
-    # python doesn't copy objects and if we delete from the list we're
-    # iterating over it loses its place.
-    check_files = copy.copy(files)
-    for file in check_files:
-      full_file = os.path.join(root, file)
-
-      # if the file isn't in the list, delete it.
-      if full_file not in keep_list:
-        if not FLAGS.quiet:
-          print('  Deleting file "%s"' % full_file)
-        file_count += 1
-        files.remove(file)
-        try:
-          os.remove(full_file)
-        except (IOError, OSError) as e:
-          error_exit('Failed to delete file "%s":\n  %s' %
-                     (full_file, e), 6)
-
-    # Do not remove the base directory.
-    if root is base:
-      continue
-
-    if len(files) == 0:
-      # dirs is generated before we get here so we may still have
-      # directories in the list that have already been deleted
-      # check that they still exist and continue out the for loop
-      # if any do.
-      empty = True
-      for adir in dirs:
-        if os.path.isdir(os.path.join(root, adir)):
-          empty = False
-          break
-      if not empty:
+  verbose = not FLAGS.quiet
+
+  # Walk the tree bottom up with an explicit stack. Each directory is
+  # pushed twice, once to delete files from it and once, after all of
+  # its sub-directories are done, to check if it is now empty.
+  # Count what is left in each directory as we go so that check
+  # doesn't need to list the directory again.
+  remaining = {}
+  stack = [(base, None, False)]
+  while stack:
+    (root, parent, done) = stack.pop()
+
+    if done:
+      # Do not remove the base directory.
+      if remaining.pop(root) or root == base:
         continue
 
-      if not FLAGS.quiet:
-        print('  Deleting directory "%s"' % root)
-      dir_count += 1      
+      if verbose:
+        sys.stdout.write('  Deleting directory "%s"\n' % root)
+      dir_count += 1
       try:
         os.rmdir(root)
       except (IOError, OSError) as e:
         error_exit('Failed to delete directory "%s":\n  %s' %
-                   (full_file, e), code=6)
+                   (root, e), code=6)
+      remaining[parent] -= 1
+      continue
+
+    stack.append((root, parent, True))
+    remaining[root] = 0
+    try:
+      with os.scandir(root) as entries:
+        for entry in entries:
+          # Like os.walk, don't follow symlinks to directories.
+          if entry.is_dir():
+            remaining[root] += 1
+            if not entry.is_symlink():
+              stack.append((entry.path, root, False))
+            continue
+
+          # if the file isn't in the set, delete it.
+          if entry.path not in keep_set:
+            if verbose:
+              sys.stdout.write('  Deleting file "%s"\n' % entry.path)
+            file_count += 1
+            try:
+              os.remove(entry.path)
+            except (IOError, OSError) as e:
+              error_exit('Failed to delete file "%s":\n  %s' %
+                         (entry.path, e), 6)
+          else:
+            remaining[root] += 1
+    except (IOError, OSError) as e:
+      error_exit('Failed to read directory "%s":\n  %s' % (root, e), code=6)
 
   return (file_count, dir_count)
 
+###########################################################################
+# Return a dict of the sizes of all files under base keyed by path.
+# Uses os.scandir so file types come from the directory listing, only
+# files need a stat for their size.
+def tree_sizes(base):
+  sizes = {}
+  if not os.path.isdir(base):
+    return sizes
+
+  stack = [base]
+  while stack:
+    root = stack.pop()
+    try:
+      with os.scandir(root) as entries:
+        for entry in entries:
+          if entry.is_dir():
+            if not entry.is_symlink():
+              stack.append(entry.path)
+          elif entry.is_file():
+            sizes[entry.path] = entry.stat().st_size
+    except (IOError, OSError) as e:
+      error_exit('Failed to read directory "%s":\n  %s' % (root, e), code=6)
+
+  return sizes
+
+###########################################################################
+# Return the size of a file, or print an error and return None if it
+# can't be found.
+def file_size(path):
+  try:
+    return os.path.getsize(path)
+  except (IOError, OSError) as e:
+    error_exit('Failed to get filesize: %s' % e)
+  return None
+
+###########################################################################
+# FICLONE ioctl from linux/fs.h, makes dst share src's data blocks on
+# filesystems with reflinks (btrfs, XFS and others).
+FICLONE = 0x40049409
+
+# Errors meaning the filesystems can't do a clone or copy_file_range
+# between these files, rather than that the copy itself failed.
+FAST_COPY_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTTY,
+                    errno.EOPNOTSUPP, errno.ENOTSUP)
+
+# Buffer size for copies that have to go through python.
+COPY_BUFSIZE = 1 << 20
+
+###########################################################################
+# Copy a file's contents from src to dst without passing the data
+# through python. On Linux first try to clone the file, then
+# copy_file_range lets the kernel (or the filesystem, with server side
+# copies) do the work.
+# Otherwise, or if the filesystems can't do that, use shutil.copyfile
+# which uses sendfile/fcopyfile itself from python 3.8.
+def fast_copy(src, dst):
+  # Opening dst truncates it, if it is src (say through a hard link) that
+  # would empty the source. Refuse like shutil.copyfile does.
+  if os.path.exists(dst) and os.path.samefile(src, dst):
+    raise shutil.SameFileError('"%s" and "%s" are the same file' %
+                               (src, dst))
+  if sys.platform.startswith('linux'):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+      if fcntl is not None:
+        try:
+          fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+          return
+        except OSError as e:
+          if e.errno not in FAST_COPY_ERRNOS:
+            raise
+      if hasattr(os, 'copy_file_range'):
+        try:
+          # Some filesystems accept the call but copy nothing, so check
+          # the whole file made it and fall back if it didn't.
+          size = os.fstat(fsrc.fileno()).st_size
+          copied = 0
+          while True:
+            count = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                       1 << 30)
+            if not count:
+              break
+            copied += count
+          if copied >= size:
+            return
+        except OSError as e:
+          if e.errno not in FAST_COPY_ERRNOS:
+            raise
+  shutil.copyfile(src, dst)
+
+###########################################################################
+# Cancel any of a list of futures that haven't started yet. Used when
+# a pool is interrupted or fails, otherwise leaving the executor's with
+# block would wait for every queued job to run.
+def cancel_futures(futures):
+  for future in futures:
+    future.cancel()
+
+###########################################################################
+# Copy one track to the destination, run from the copy thread pool.
+# If link_dev is given and the track is on that device hard link it
+# rather than copying it.
+def copy_track(local_file, remote_file, link_dev=None):
+  try:
+    if link_dev is not None and os.stat(local_file).st_dev == link_dev:
+      if not FLAGS.quiet:
+        # One write per message so lines from different threads don't mix.
+        sys.stdout.write('  Linking "%s"\n   to "%s".\n' %
+                         (local_file, remote_file))
+      if os.path.lexists(remote_file):
+        os.remove(remote_file)
+      os.link(local_file, remote_file)
+    else:
+      if not FLAGS.quiet:
+        sys.stdout.write('  Copying "%s"\n   to "%s".\n' %
+                         (local_file, remote_file))
+      # Replace rather than write into an existing file, it may be a
+      # hard link to the track from an earlier --link run.
+      if os.path.lexists(remote_file):
+        os.remove(remote_file)
+      ## This copy could be switched to the rsync algorithm?
+      fast_copy(local_file, remote_file)
+  except (IOError, OSError) as e:
+    error_exit('Failed to copy to file "%s":\n  %s' %
+               (remote_file, e), code=6)
+
 ###########################################################################
 # Print an error to stderr and exit with exit code if one is given.
 def error_exit(text, code=None):
@@ -216,8 +461,8 @@ def error_exit(text, code=None):
 ###########################################################################
 # Return the last line of a traceback.
 def trace_last():
-  return traceback.format_exception(sys.exc_info()[0], sys.exc_info()[1],
-                                    sys.exc_info()[2])[-1]
+  (exc_type, exc_value, exc_tb) = sys.exc_info()
+  return traceback.format_exception(exc_type, exc_value, exc_tb)[-1]
 
 ###########################################################################
 class tunes_xml:
@@ -248,6 +493,23 @@ class tunes_xml:
     [u'Smart Criteria', 'S'],
   )
 
+  # The parts of the XML that are used, everything else is skipped
+  # while parsing.
+  xml_schema = {
+    u'Major Version': None,
+    u'Minor Version': None,
+    u'Date': None,
+    u'Music Folder': None,
+    u'Tracks': {
+      '*': dict.fromkeys([u'Track ID', u'Location', u'Kind', u'Protected',
+                          u'Size']),
+    },
+    u'Playlists': [
+      dict([(flag[0], None) for flag in playlist_flagset] +
+           [(u'Name', None), (u'Playlist Items', [{u'Track ID': None}])]),
+    ],
+  }
+
   def __init__(self, xmlfile, types=None, all_types=False, video=False):
     # Init and parse the XML.
     try:
@@ -260,10 +522,7 @@ class tunes_xml:
                  (FLAGS.itunes, trace_last()), code=4)
 
     try:
-      if sys.version_info[0] == 3:
-        self.tunes = plistlib.load(f)
-      else:
-        self.tunes = plistlib.readPlist(f)
+      self.tunes = read_plist(f, self.xml_schema)
     except IOError as e:
       error_exit('Cannot open "%s": %s' % (FLAGS.itunes, e), code=4)
     except:
@@ -274,18 +533,43 @@ class tunes_xml:
     f.close()
 
     # Store what type(s) of files to use.
+    # Kept as a set as every track's suffix is checked against it.
     if types is None:
-      self.types = ['mp2','mp3']
+      self.types = set(['mp2','mp3'])
     else:
-      self.types = types
+      self.types = set(types)
     self.all_types = all_types
     self.video = video
 
+    # Local filenames of tracks, converted from their URLs on first use.
+    self.track_names = {}
+    # Cached results of __track_ok and playlist_tracks.
+    self.tracks_ok = {}
+    self.plist_tracks = {}
+
+    # Index tracks by their Track ID, the same integer playlists refer
+    # to them by, rather than the string keys in the XML.
+    # Only keep tracks that could ever be exported, ones we know the
+    # location, kind and size of (without a size it isn't local) and
+    # that aren't protected, so we can't play them outside of iTunes.
+    # Bound once here rather than looked up in self.tunes on every use.
+    self.track_objs = {}
+    if self.__has_key(u'Tracks'):
+      for track_obj in self.tunes[u'Tracks'].values():
+        if (u'Track ID' in track_obj and u'Location' in track_obj and
+            u'Kind' in track_obj and u'Size' in track_obj and
+            not u'Protected' in track_obj):
+          self.track_objs[track_obj[u'Track ID']] = track_obj
+      self.tunes[u'Tracks'] = self.track_objs
+
     # Create an index to all playlist objects.
     self.plist_index = {}
     for plist_obj in self.__key(u'Playlists'):
       if u'Name' in plist_obj:
         self.plist_index[plist_obj[u'Name']] = plist_obj
+    # Playlists are only looked up by name from here on, don't keep the
+    # list around as well.
+    del self.tunes[u'Playlists']
 
   def __has_key(self, key):
     # Return a key from the tunes xml.
@@ -308,9 +592,7 @@ class tunes_xml:
 
   def __playlist_obj(self, plist_name):
     # Return a specific playlist object if it exists.
-    if plist_name in self.plist_index:
-      return self.plist_index[plist_name]
-    return None
+    return self.plist_index.get(plist_name)
 
   def playlist_flags(self, plist_name):
     # Return flags denoting things about a playlist, such as if it is
@@ -325,34 +607,35 @@ class tunes_xml:
     return flags
 
   def playlist_tracks(self, plist_name):
+    # Return tracks from a playlist in a usable form, cached per playlist.
+    if plist_name not in self.plist_tracks:
+      self.plist_tracks[plist_name] = self.__playlist_tracks(plist_name)
+    return self.plist_tracks[plist_name]
+
+  def __playlist_tracks(self, plist_name):
     # Return tracks from a playlist in a usable form.
     plist_obj = self.__playlist_obj(plist_name)
     if not plist_obj:
       return None
     tracks = []
-    if u'Playlist Items' in plist_obj:
-      for track_gobj in plist_obj[u'Playlist Items']:
-        if u'Track ID' in track_gobj:
-          track = str(track_gobj[u'Track ID'])
-          if self.__track_ok(track):
-            tracks.append(track)
+    for track_gobj in plist_obj.get(u'Playlist Items', ()):
+      track = track_gobj.get(u'Track ID')
+      if track is not None and self.__track_ok(track):
+        tracks.append(track)
     return tracks
 
   def __track_ok(self, track):
-    # Return if a track is ok to output or not.
-    track_obj = self.__track_obj(track)
+    # Return if a track is ok to output or not, cached per track.
+    if track not in self.tracks_ok:
+      self.tracks_ok[track] = self.__check_track(track)
+    return self.tracks_ok[track]
 
-    # If we don't know where the track is or what it is we can't do
-    # anything with it.
-    if not u'Location' in track_obj:
-      return False
-    if not u'Kind' in track_obj:
-      return False
-    # if it's protected then we can't play it outside of iTunes.
-    if u'Protected' in track_obj:
-      return False
-    # If the track has no size then it isn't local.
-    if not u'Size' in track_obj:
+  def __check_track(self, track):
+    # Return if a track is ok to output or not.
+    # Tracks without a location, kind or size and protected tracks were
+    # dropped after parsing.
+    track_obj = self.track_objs.get(track)
+    if track_obj is None:
       return False
 
     # If we are not exporting video files, ignore them.
@@ -384,58 +667,55 @@ class tunes_xml:
 
   def __track_obj(self, track):
     # Take a track id and return a track object.
-    try:
-      return self.tunes[u'Tracks'][track]
-    except:
-      error_exit('Failed to use iTunes XML data for track "%s": %s' %
-                 (track, trace_last()), code=4)
+    track_obj = self.track_objs.get(track)
+    if track_obj is None:
+      error_exit('Failed to use iTunes XML data for track "%s":'
+                 ' no such track' % track, code=4)
+    return track_obj
 
   def track_size(self, track):
     # Convert a track id to a track size in bytes.
+    # Tracks that are ok always have a size.
     if self.__track_ok(track):
-      track_obj = self.__track_obj(track)
-      try:
-        result = track_obj[u'Size']
-      except:
-        error_exit('Failed to use iTunes XML data for track "%s": %s' %
-                   (track, trace_last()), code=4)
-      return result
+      return self.__track_obj(track)[u'Size']
     else:
       return 0
 
   def name_convert(self, filename):
     # Pull the path section out of a returned URL. Assume it is local
     # because the rest of the script won't work otherwise.
+    # iTunes always uses file:// URLs, where the path starts at the
+    # first slash after the host, so just slice that off.
+    if filename.startswith('file://'):
+      start = filename.find('/', 7)
+      if start != -1:
+        return unquote(filename[start:])
     return unquote(urlsplit(filename)[2])
 
   def track_name(self, track):
-    # Convert a string track id to a local filename.
-    try:
-      result = self.__track_obj(track)[u'Location']
-    except:
-      error_exit('Failed to use iTunes XML data for track "%s": %s' %
-                 (track, trace_last()), code=4)
-    return self.name_convert(result)
+    # Convert a track id to a local filename.
+    result = self.track_names.get(track)
+    if result is not None:
+      return result
+    # Tracks in the index always have a location.
+    result = self.name_convert(self.__track_obj(track)[u'Location'])
+    self.track_names[track] = result
+    return result
 
   def track_suffix(self, track):
-    # Convert a string track id to a local filename suffix.
+    # Convert a track id to a local filename suffix.
     name = self.track_name(track)
     suffix = name.split('.')[-1]
-    if suffix is name:
+    if suffix == name:
       return ''
     return suffix.lower()
 
   def tracks(self):
     # Return a list of global track ids.
-    if not self.__has_key(u'Tracks'):
-      return []
     tracks = []
-    for track in self.__key(u'Tracks'):
-      track = str(track)
-      track_gobj = self.__key(u'Tracks')[track]
-      if u'Track ID' in track_gobj:
-        if self.__track_ok(track):
-          tracks.append(track)
+    for track in self.track_objs:
+      if self.__track_ok(track):
+        tracks.append(track)
     return tracks
 
   def music_folder(self):
@@ -545,6 +825,19 @@ def main():
                     default='',
                     help='Store the list of track filenames in all playlists'
                     ' to a file given to this option')
+  args.add_argument('--jobs', '-j',
+                    type=int,
+                    default=4,
+                    metavar='N',
+                    help='Number of tracks to check or copy at the same'
+                    ' time')
+  args.add_argument('--link',
+                    action='store_true',
+                    default=False,
+                    help='Hard link tracks rather than copying them when'
+                    ' the destination is on the same filesystem. Linked'
+                    ' tracks share their data with the library, editing'
+                    ' one edits the other')
   args.add_argument('--nolowercase',
                     action='store_true',
                     default=False,
@@ -598,11 +891,10 @@ def main():
     print('Playlists found:')
     for plist in itxml.playlists():
       qname = '\'%s\'' % plist
-      size = 0
-      for track in itxml.playlist_tracks(plist):
-        size += itxml.track_size(track)
+      plist_tracks = itxml.playlist_tracks(plist)
+      size = sum([itxml.track_size(track) for track in plist_tracks])
       print('  %-43s %8d tracks %10s %6s' %
-             (qname, len(itxml.playlist_tracks(plist)), bytes2human(size),
+             (qname, len(plist_tracks), bytes2human(size),
              itxml.playlist_flags(plist)))
     sys.exit(0)
 
@@ -611,6 +903,8 @@ def main():
     args.error('one of the arguments --dest/-d --list/-l is required')
   if len(FLAGS.plists) == 0 and not FLAGS.all_plists:
     args.error('one of the arguments --plists/-p --all-plists/-a is required')
+  if FLAGS.jobs < 1:
+    args.error('argument --jobs/-j must be at least 1')
 
   if FLAGS.noop:
     print('noop: No-op mode, no changes will be made!')
@@ -653,15 +947,17 @@ def main():
   # ones we want to export that aren't empty and aren't being ignored.
   playlists = []
   ignored_playlists = []
+  wanted_plists = set(FLAGS.plists)
+  ignore_plists = set(FLAGS.plists_ignore)
   for plist in itxml.playlists():
     # If we have a match, copy the lists.
-    if plist in FLAGS.plists_ignore:
+    if plist in ignore_plists:
       #if not FLAGS.quiet:
       #  print('Playlist in --plist-ignore: %s' % plist)
       ignored_playlists.append(plist)
 
     # If we're not ignoring the playlist check if we want it.
-    elif FLAGS.all_plists or plist in FLAGS.plists:
+    elif FLAGS.all_plists or plist in wanted_plists:
       if len(itxml.playlist_tracks(plist)) == 0:
         #if not FLAGS.quiet:
         #  print('Ignoring empty playlist: %s' % plist)
@@ -674,9 +970,9 @@ def main():
   if FLAGS.all_plists:
     missing_playlists = []
   else:
-    missing_playlists = copy.copy(FLAGS.plists)
-    for plist in playlists:
-      missing_playlists.remove(plist)
+    found_plists = set(playlists)
+    missing_playlists = [plist for plist in FLAGS.plists
+                         if plist not in found_plists]
 
   print('Playlist(s) to be copied: %s' % quote_list(playlists))
   if missing_playlists:
@@ -684,22 +980,44 @@ def main():
   if ignored_playlists:
     print('Playlist(s) ignored: %s' % quote_list(ignored_playlists))
 
+  # Generate a unique list of all track ids required from all playlists
+  # that are to be copied. Needed in noop mode too for the checks below.
+  tracks_set = set()
+  for plist in playlists:
+    tracks_set.update(itxml.playlist_tracks(plist))
+  tracks = list(tracks_set)
+
+  # Work out the destination filename of each track once, rather than
+  # for every playlist it is in and again when syncing.
+  remote_files = {}
+  for track in tracks:
+    remote_files[track] = fat32_convert(itxml.track_name(track),
+                                        oldbase=musicdir, newbase=music)
+
   if FLAGS.noop:
     print('noop: not creating playlists.')
   else:
     if not FLAGS.quiet:
       print('Creating playlists.')
 
-    # Generate a unique list of all track ids required from all playlists
-    # that are to be copied.
-    # Also keep track of what playlist files we create.
-    tracks = []
+    # As well as filename rewriting the paths in playlists need to be
+    # relative to the playlists directory and DOS style paths with
+    # backslashes rather than slashes.
+    rebase = not FLAGS.plist_norebase
+    backslash = FLAGS.plists_backslash and os.sep != '\\'
+    plist_names = {}
+    for track in tracks:
+      track_name = remote_files[track]
+      if rebase:
+        track_name = os.path.relpath(track_name, plist_dir)
+      if backslash:
+        track_name = track_name.replace(os.sep, '\\')
+      plist_names[track] = track_name
+
+    # Keep track of what playlist files we create.
     playlist_files = []
     for plist in playlists:
-      # Add the tracks from this playlist to the general list, keeping it
-      # unique with a set conversion.
       plist_tracks = itxml.playlist_tracks(plist)
-      tracks = list(set(tracks + plist_tracks))
       # Remove any bad characters that can't be used in filenames.
       plist_filename = fat32_convert('%s%s.m3u' % (FLAGS.plists_prefix,
                                                    plist),
@@ -726,23 +1044,14 @@ def main():
 
         # Write out the #EXTM3U line to help some players identify
         # the playlist type, if the option is on.
+        lines = []
         if FLAGS.plist_extm3u:
-          plist_file.write('#EXTM3U\n')
-        
-        for track in plist_tracks:
-          # As well as filename rewriting these paths need to be relative
-          # to the playlists directory and DOS style paths with backslashes
-          # rather than slashes.
-          track_name = itxml.track_name(track)
-          track_name = fat32_convert(track_name, oldbase=musicdir,
-                                     newbase=music)
-          if not FLAGS.plist_norebase:
-            track_name = os.path.relpath(track_name, plist_dir)
-          if FLAGS.plists_backslash and os.sep != '\\':
-            track_name = track_name.replace(os.sep, '\\')
-
-          plist_file.write('%s\n' % track_name)
-        plist_file.close()
+          lines.append('#EXTM3U')
+        lines.extend([plist_names[track] for track in plist_tracks])
+
+        # Write the whole playlist at once.
+        with plist_file:
+          plist_file.write('\n'.join(lines) + '\n')
     print('Number of tracks in desired playlists: %d' % len(tracks))
 
   if FLAGS.noop:
@@ -752,7 +1061,7 @@ def main():
   else:  
     if not FLAGS.quiet:
       print('Cleaning up old playlists.')
-    (files, dirs) = clean_tree(plist_dir, playlist_files)
+    (files, dirs) = clean_tree(plist_dir, set(playlist_files))
     if not FLAGS.quiet:
       print('  Removed %i files and %i directories.' % (files, dirs))
 
@@ -782,12 +1091,33 @@ def main():
       error_exit('Failed to open tracklist "%s":\n   %s' %
                  (FLAGS.tracklist, e), code=6)
 
-  synced_tracks = []
+  # Get the sizes of files already in the destination with one walk
+  # rather than stat'ing the destination for every track.
+  if FLAGS.nocopy or FLAGS.force:
+    remote_sizes = {}
+  else:
+    remote_sizes = tree_sizes(music)
+
+  # Get the sizes of the local files of tracks that are already in the
+  # destination. Each is a separate stat so run them in parallel.
+  check_files = [itxml.track_name(track) for track in tracks
+                 if remote_files[track] in remote_sizes]
+  with concurrent.futures.ThreadPoolExecutor(FLAGS.jobs) as executor:
+    stats = [executor.submit(file_size, local_file)
+             for local_file in check_files]
+    try:
+      local_sizes = dict(zip(check_files, [stat.result() for stat in stats]))
+    except BaseException:
+      # Interrupted, don't wait for the rest of the stats.
+      cancel_futures(stats)
+      raise
+
+  synced_tracks = set()
   to_sync_tracks = []
   to_sync_size = 0
   for track in tracks:
     local_file = itxml.track_name(track)
-    remote_file = fat32_convert(local_file, oldbase=musicdir, newbase=music)
+    remote_file = remote_files[track]
 
     if FLAGS.tracklist != '':
       tracklist_file.write('%s\n' % local_file)
@@ -799,20 +1129,15 @@ def main():
         ## still collides).
         error_exit('WARNING: remote filename collision: "%s"' % remote_file)
       # Append the name to the list of all files in the playlists.
-      synced_tracks.append(remote_file)
+      synced_tracks.add(remote_file)
 
       # Check if remote file exists already.
-      if not FLAGS.force and os.path.isfile(remote_file):
-        # If it exists, compare size with os.path.getsize() before copying.
-        try:
-          local_size = os.path.getsize(local_file)
-          remote_size = os.path.getsize(remote_file)
-        except (IOError, OSError) as e:
-          error_exit('Failed to get filesize: %s' % e)
-        else:
-          if local_size == remote_size:
-            # File exists and is the same size, skip it.
-            continue
+      remote_size = remote_sizes.get(remote_file)
+      if remote_size is not None:
+        # If it exists, compare size with the local file before copying.
+        if local_sizes[local_file] == remote_size:
+          # File exists and is the same size, skip it.
+          continue
 
       # If the file doesn't exist or the filesize doesn't match
       # list the file to be copied.
@@ -820,7 +1145,8 @@ def main():
       to_sync_size += itxml.track_size(track)
 
   # finished writing out track names to a file
-  tracklist_file.close()
+  if FLAGS.tracklist != '':
+    tracklist_file.close()
 
   if FLAGS.nocopy:
     # Nothing to check, copy or delete. Don't do anything else.
@@ -840,6 +1166,8 @@ def main():
 
   # Now that we've freed up whatever disk space can be by deleting things
   # copy any remaining tracks that are needed.
+  # Copy in destination order so each directory is written in one go.
+  to_sync_tracks.sort(key=lambda track: track[1])
   remaining_tracks = len(to_sync_tracks)
   if remaining_tracks == 0:
     print('No tracks to copy.')
@@ -849,30 +1177,54 @@ def main():
     else:
       print('Copying %i remaining tracks.' % remaining_tracks)
 
-    count = 0
-    for (local_file, remote_file) in to_sync_tracks:
-      count += 1
-      if FLAGS.noop:
-        if not FLAGS.quiet:
-          print('  noop: not copying "%s"\n   to "%s".' %
-                 (local_file, remote_file))
-      else:
-        if FLAGS.quiet:
-          if FLAGS.progress:
-            if count % 100 == 0:
-              sys.stdout.write('#')
-              sys.stdout.flush()
-        else:
-          print('  Copying "%s"\n   to "%s".' % (local_file, remote_file))
-
-        # Make the full path exist if it doesn't already.
-        mk_missing_dirs(os.path.dirname(remote_file), music)
+    if FLAGS.noop:
+      if not FLAGS.quiet:
+        sys.stdout.write(''.join(['  noop: not copying "%s"\n   to "%s".\n' %
+                                  (local_file, remote_file)
+                                  for (local_file, remote_file)
+                                  in to_sync_tracks]))
+    else:
+      # Make the full paths exist if they don't already, before starting
+      # any copies so the copy threads don't race to create them.
+      # Directories holding synced files that were already there exist,
+      # the cleanup above won't have removed them.
+      known_dirs = set([os.path.dirname(remote_file)
+                        for remote_file in synced_tracks
+                        if remote_file in remote_sizes])
+      for direct in sorted(set([os.path.dirname(remote_file)
+                                for (local_file, remote_file)
+                                in to_sync_tracks]) - known_dirs):
+        mk_missing_dirs(direct, music)
+
+      # Tracks are only hard linked if they are on the same filesystem
+      # as the destination.
+      link_dev = None
+      if FLAGS.link:
+        link_dev = os.stat(music).st_dev
+
+      # When shutil has to fall back to read/write use bigger buffers
+      # than its 64KB default, tracks are several MB each. Python 3.8+.
+      if 0 < getattr(shutil, 'COPY_BUFSIZE', 0) < COPY_BUFSIZE:
+        shutil.COPY_BUFSIZE = COPY_BUFSIZE
+
+      count = 0
+      with concurrent.futures.ThreadPoolExecutor(FLAGS.jobs) as executor:
+        copies = [executor.submit(copy_track, local_file, remote_file,
+                                  link_dev)
+                  for (local_file, remote_file) in to_sync_tracks]
         try:
-          ## This copy could be switched to the rsync algorithm?
-          shutil.copyfile(local_file, remote_file)
-        except (IOError, OSError) as e:
-          error_exit('Failed to copy to file "%s":\n  %s' %
-                     (remote_file, e), code=6)
+          for done in concurrent.futures.as_completed(copies):
+            done.result()
+
+            count += 1
+            if FLAGS.quiet and FLAGS.progress:
+              if count % 100 == 0:
+                sys.stdout.write('#')
+                sys.stdout.flush()
+        except BaseException:
+          # A copy failed or we were interrupted, don't start any more.
+          cancel_futures(copies)
+          raise
 
     # Print a newline after progress printing above.
     if FLAGS.quiet and FLAGS.progress:
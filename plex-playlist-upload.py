@@ -13,9 +13,9 @@
 # pip3 install plexapi
 # python3 -m pip install plexapi
 
-import glob
-import os.path
+import os
 import pathlib
+import re
 import sys
 
 from plexapi.server import PlexServer
@@ -27,18 +27,26 @@ PLEX_AUTH='XXXXXXXXXXXXXXXXXXXX'
 MUSIC='Music'
 PLEX_PREFIX='/volume1/music/itunes/'
 PL_DIR='/Users/you/Music/iTunes/playlists'
+# Number of items to fetch from plex per request.
+PLEX_CONTAINER_SIZE=1000
+
+# Leading '../' parts of playlist paths.
+PARENT_DIRS_RE=re.compile(r'^(?:\.\./)+')
 
 
 def playlist_file(filename, tracks):
   items=[]
   i=0
   with open(filename, 'r', encoding='utf-8') as infile:
-    for line in infile.readlines():
+    for line in infile:
       if line.startswith('#'):
         continue
       i+=1
       # Chamge the filename/path in the file to how it appears to plex
-      line=PLEX_PREFIX + line.rstrip().replace('\\', '/').lstrip('../')
+      # Only strip whole '../' parts, lstrip('../') would also eat the
+      # leading dots of a name.
+      line=PLEX_PREFIX + PARENT_DIRS_RE.sub(
+          '', line.rstrip().replace('\\', '/'), count=1)
       if line in tracks:
         items.append(tracks[line])
       else:
@@ -59,10 +67,10 @@ def main():
 
   print('Fetching track and playlist data.')
 
-  tracks={}
-  for track in music.search(libtype='track'):
-    if len(track.locations) > 0:
-      tracks[track.locations[0]]=track
+  tracks={track.locations[0]: track
+          for track in music.search(libtype='track',
+                                    container_size=PLEX_CONTAINER_SIZE)
+          if track.locations}
 
   playlists={}
   for playlist_obj in music.playlists():
@@ -70,7 +78,11 @@ def main():
 
   count=0
   updated=0
-  for pl_file in glob.glob(PL_DIR + '/*.m3u'):
+  # Like glob('*.m3u') this skips dot files.
+  pl_files=[entry.path for entry in os.scandir(PL_DIR)
+            if entry.name.endswith('.m3u') and
+            not entry.name.startswith('.') and entry.is_file()]
+  for pl_file in pl_files:
     count+=1
     name=pathlib.PurePath(pl_file).stem
     print('Playlist: %s' % name, end='')
@@ -88,11 +100,13 @@ def main():
         # Differences between the local playlist and plex
         updated+=1
         print('  Updating playlist contents from local')
+        plex_set=set(plex_items)
+        items_set=set(items)
         # Do a simple, faster, update.
-        playlist.removeItems(list(set(plex_items).difference(set(items))))
+        playlist.removeItems(list(plex_set.difference(items_set)))
         # Add items in the order they are in the local list, more likely
         # We won't need to redo the whole playlist.
-        playlist.addItems([x for x in items if x not in plex_items])
+        playlist.addItems([x for x in items if x not in plex_set])
 
         # See if the playlist is now correct.
         if playlist.items() != items:
@@ -103,8 +117,8 @@ def main():
           playlist.removeItems(plex_items)
           playlist.addItems(items)
 
-        if playlist.items() != items:
-          print('  Failed to reset playlist contents from local')
+          if playlist.items() != items:
+            print('  Failed to reset playlist contents from local')
 
   print('\nFinished. %s playlists done, %s updated.' % (count, updated))
 